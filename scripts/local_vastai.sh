@@ -93,6 +93,21 @@ check_env() {
     fi
 }
 
+# 런처 스크립트 의존성 확인
+check_deps() {
+    if ! python3 -c "import sys; sys.exit(sys.version_info < (3, 10))" 2>/dev/null; then
+        log_error "scripts/vastai_launcher.py requires Python 3.10+"
+        exit 1
+    fi
+
+    if ! python3 -c "import requests, orjson, ijson" 2>/dev/null; then
+        log_error "Missing Python packages for scripts/vastai_launcher.py"
+        echo "Install them with:"
+        echo "  pip install requests orjson ijson"
+        exit 1
+    fi
+}
+
 # 인자 파싱
 DOCKER_USERNAME=""
 GPU_TYPE="RTX 4090"
@@ -175,6 +190,7 @@ main() {
     echo ""
 
     check_env
+    check_deps
 
     cd "$PROJECT_DIR"
 
@@ -7,20 +7,30 @@ Vast.ai 자동 인스턴스 선택 및 실행 스크립트
 """
 
 import argparse
+import contextlib
+import hashlib
+import ijson
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import time
 import os
+import re
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Optional, List
+from types import MappingProxyType
+from typing import Iterator, Mapping, Optional, List
 
 
 # ============================================================
 # 설정
 # ============================================================
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Config:
     # Vast.ai API 키
     api_key: str = ""
@@ -37,44 +47,213 @@ class Config:
     num_gpus: int = 1
 
     # 선호 GPU
-    preferred_gpus: tuple = ("RTX 4090",)
+    preferred_gpus: frozenset = frozenset({"RTX 4090"})
 
     # 실행 설정
     disk_space: float = 50.0
 
     # 환경변수 (Docker 컨테이너에 전달)
-    env_vars: dict = field(default_factory=dict)
+    env_vars: Mapping = field(default_factory=lambda: MappingProxyType({}), hash=False)
 
     # 학습 설정
     config_file: str = "configs/config.yaml"
     extra_args: str = ""
 
+    # build_env_vars에서 재사용할 고정 환경변수 (빈 값은 미리 제거)
+    _env_base: Mapping = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # frozen 인스턴스이므로 파생 필드는 object.__setattr__로 설정
+        object.__setattr__(self, "env_vars", MappingProxyType(dict(self.env_vars)))
+
+        env = {
+            "WANDB_API_KEY": self.env_vars.get("wandb_key", ""),
+            "AWS_ACCESS_KEY_ID": self.env_vars.get("aws_key", ""),
+            "AWS_SECRET_ACCESS_KEY": self.env_vars.get("aws_secret", ""),
+            "AWS_DEFAULT_REGION": self.env_vars.get("aws_region", "ap-northeast-2"),
+            "S3_DATA_PATH": self.env_vars.get("s3_path", ""),
+        }
+        object.__setattr__(self, "_env_base",
+                           MappingProxyType({k: v for k, v in env.items() if v}))
+
 
 # ============================================================
 # API 클라이언트
 # ============================================================
 
+class VastRetry(Retry):
+    """메서드별 재시도 정책: 조회(GET)는 status_forcelist, 인스턴스 생성(PUT)은 PUT_STATUS_FORCELIST"""
+
+    # 인스턴스 생성(PUT)은 멱등하지 않으므로 503(서비스 불가, 보통 요청을 받기 전에 거절)만 재시도
+    # 502/504/read timeout은 게이트웨이 뒤에서 이미 대여가 처리됐을 수 있어 재시도하면 중복 생성 위험
+    # (연결 실패는 요청이 전송되지 않은 경우이므로 메서드와 무관하게 재시도됨)
+    PUT_STATUS_FORCELIST = frozenset([503])
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method.upper() == "PUT":
+            return status_code in self.PUT_STATUS_FORCELIST
+        return super().is_retry(method, status_code, has_retry_after)
+
+
 class VastClient:
     BASE_URL = "https://console.vast.ai/api/v0"
+    # vastai CLI가 쓰는 ~/.cache/vastai와 겹치지 않도록 런처 전용 디렉터리 사용
+    CACHE_DIR = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                             "vastai-auto-launcher")
+    # 런처가 만든 파일(<key>.json, <key>.json.meta, <key>.*.tmp)만 정리 대상
+    CACHE_FILE_RE = re.compile(r"^[0-9a-f]{16}\.(json|json\.meta|[A-Za-z0-9_]+\.tmp)$")
+    CACHE_TTL = 60             # 이 시간(초) 안에 받은 응답은 재요청 없이 사용
+    CACHE_MAX_AGE = 24 * 3600  # 이보다 오래된 캐시 파일은 삭제
 
     def __init__(self, api_key: str):
         self.api_key = api_key
-        self.headers = {"Accept": "application/json"}
 
-    def search_offers(self) -> list:
-        """사용 가능한 인스턴스 목록 조회"""
+        # 요청마다 TCP/TLS 연결을 새로 맺지 않도록 세션을 재사용 (keep-alive)
+        self.session = requests.Session()
+        self.session.headers.update({"Accept": "application/json"})
+        # API 키는 세션 기본 파라미터로 두고, 호출별 파라미터와 자동 병합
+        self.session.params = {"api_key": api_key}
+
+        # 조회(GET) 요청은 429/5xx 및 일시적인 네트워크 오류 시 지수 백오프로 재시도
+        # (PUT은 read 오류 후 재시도하지 않도록 allowed_methods에서 제외, 상태 코드는 VastRetry 참고)
+        retries = VastRetry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+        )
+        self.session.mount("https://", HTTPAdapter(max_retries=retries,
+                                                   pool_connections=4, pool_maxsize=8))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        """세션 및 커넥션 풀 정리"""
+        self.session.close()
+
+    def search_offers(self, cfg: Config) -> Iterator[dict]:
+        """사용 가능한 인스턴스 목록 조회 (조건 필터링은 서버에서 수행)"""
         url = f"{self.BASE_URL}/bundles/"
-        params = {"api_key": self.api_key}
 
-        response = requests.get(url, headers=self.headers, params=params)
-        response.raise_for_status()
-        return response.json().get("offers", [])
+        query = {
+            "gpu_name": {"in": sorted(cfg.preferred_gpus)},
+            "num_gpus": {"eq": cfg.num_gpus},
+            "dph_total": {"lte": cfg.max_price_per_hour},
+            "reliability2": {"gte": cfg.min_reliability},
+            "disk_space": {"gte": cfg.min_disk_space},
+            "inet_down": {"gte": cfg.min_inet_down},
+            "inet_up": {"gte": cfg.min_inet_up},
+            "rentable": {"eq": True},
+            "order": [["dph_total", "asc"]],
+        }
+
+        # 캐시 키가 실행마다 같도록 직렬화 순서를 고정
+        params = {"q": json.dumps(query, sort_keys=True)}
+
+        # bundles 응답은 수 MB에 달하므로 전체를 메모리에 올리지 않고 스트리밍 파싱하며
+        # 조건에 맞지 않는 offer는 바로 버림
+        with self._open_body(url, params) as f:
+            for offer in ijson.items(f, "offers.item", use_float=True):
+                if offer_passes(offer, cfg):
+                    yield offer
+
+    @contextlib.contextmanager
+    def _open_body(self, url: str, params: dict):
+        """응답 본문 스트림 반환, 디스크 캐시는 가능한 경우에만 사용 (best-effort)"""
+        try:
+            f = open(self._fetch_cached(url, params), "rb")
+        except requests.RequestException:
+            # 네트워크/HTTP 오류는 캐시 문제가 아니므로 그대로 전달 (OSError의 하위 클래스)
+            raise
+        except (OSError, ValueError):
+            # 캐시 디렉터리에 쓸 수 없거나(읽기 전용 홈 등), 다른 실행이 캐시 파일을
+            # 교체/삭제했거나, 메타 파일이 손상된 경우: 캐시 없이 직접 조회해 스트리밍
+            with self.session.get(url, params=params, stream=True) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                yield response.raw
+            return
+
+        with f:
+            yield f
+
+    def _fetch_cached(self, url: str, params: dict) -> str:
+        """응답 본문을 디스크에 캐시하고 경로 반환 (ETag/Last-Modified 기반 조건부 요청)"""
+        key = hashlib.sha1(f"{url}?{sorted(params.items())}".encode()).hexdigest()[:16]
+        body_path = os.path.join(self.CACHE_DIR, f"{key}.json")
+        meta_path = f"{body_path}.meta"
+
+        # 캐시 디렉터리를 만들 수 없으면 요청 전에 실패시켜 캐시 없는 조회로 전환
+        os.makedirs(self.CACHE_DIR, exist_ok=True)
+
+        headers = {}
+        if os.path.exists(body_path) and os.path.exists(meta_path):
+            # 최근에 받은 응답은 서버에 묻지 않고 그대로 사용
+            if time.time() - os.path.getmtime(body_path) < self.CACHE_TTL:
+                return body_path
+
+            with open(meta_path, "rb") as f:
+                meta = orjson.loads(f.read())
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        with self.session.get(url, params=params, headers=headers, stream=True) as response:
+            # 변경 없음: 이전에 받아둔 본문을 그대로 사용 (TTL 갱신)
+            if response.status_code == 304:
+                os.utime(body_path)
+                os.utime(meta_path)
+                return body_path
+            response.raise_for_status()
+
+            self._evict_stale_cache()
+
+            # 동시에 실행된 다른 프로세스와 충돌하지 않도록 고유한 임시 파일에 쓴 뒤 교체
+            tmp = tempfile.NamedTemporaryFile(dir=self.CACHE_DIR, prefix=f"{key}.", suffix=".tmp",
+                                              delete=False)
+            try:
+                with tmp as f:
+                    for chunk in response.iter_content(chunk_size=1 << 16):
+                        f.write(chunk)
+                os.replace(tmp.name, body_path)
+            except BaseException:
+                # 다운로드/쓰기 도중 실패하면 불완전한 임시 파일을 남기지 않음
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp.name)
+                raise
+
+            meta = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            with open(meta_path, "wb") as f:
+                f.write(orjson.dumps(meta))
+
+        return body_path
+
+    def _evict_stale_cache(self):
+        """CACHE_MAX_AGE보다 오래된 캐시 파일 삭제"""
+        now = time.time()
+        for name in os.listdir(self.CACHE_DIR):
+            if not self.CACHE_FILE_RE.match(name):
+                continue
+            path = os.path.join(self.CACHE_DIR, name)
+            try:
+                if now - os.path.getmtime(path) > self.CACHE_MAX_AGE:
+                    os.remove(path)
+            except OSError:
+                # 다른 프로세스가 먼저 삭제한 경우 등은 무시
+                pass
 
     def create_instance(self, offer_id: int, image: str, disk: float,
                         onstart: str = "", env: dict = None) -> dict:
         """인스턴스 생성 및 실행"""
         url = f"{self.BASE_URL}/asks/{offer_id}/"
-        params = {"api_key": self.api_key}
 
         payload = {
             "client_id": "me",
@@ -86,77 +265,58 @@ class VastClient:
         if env:
             payload["env"] = env
 
-        response = requests.put(url, headers=self.headers, params=params, json=payload)
+        response = self.session.put(url, data=orjson.dumps(payload),
+                                    headers={"Content-Type": "application/json"})
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
 
     def get_instances(self) -> list:
         """내 인스턴스 목록 조회"""
         url = f"{self.BASE_URL}/instances/"
-        params = {"api_key": self.api_key, "owner": "me"}
 
-        response = requests.get(url, headers=self.headers, params=params)
+        response = self.session.get(url, params={"owner": "me"})
         response.raise_for_status()
-        return response.json().get("instances", [])
+        return orjson.loads(response.content).get("instances", [])
 
 
 # ============================================================
 # 인스턴스 선택 로직
 # ============================================================
 
-def filter_offers(offers: list, cfg: Config) -> list:
-    """조건에 맞는 인스턴스 필터링"""
-    filtered = []
-
-    for offer in offers:
-        price = offer.get("dph_total", 999)
-        reliability = offer.get("reliability2", 0)
-        disk_space = offer.get("disk_space", 0)
-        gpu_name = offer.get("gpu_name", "")
-        inet_down = offer.get("inet_down", 0)
-        inet_up = offer.get("inet_up", 0)
-        num_gpus = offer.get("num_gpus", 1)
-
-        if (price <= cfg.max_price_per_hour and
-            num_gpus == cfg.num_gpus and
-            disk_space >= cfg.min_disk_space and
-            gpu_name in cfg.preferred_gpus and
-            inet_down >= cfg.min_inet_down and
-            inet_up >= cfg.min_inet_up and
-            offer.get("rentable", False)):
-            filtered.append(offer)
+def offer_passes(offer: dict, cfg: Config) -> bool:
+    """인스턴스가 요구사항을 만족하는지 확인"""
+    # 선택도가 높은(대부분을 걸러내는) 조건부터 검사해 조기 탈락
+    if not offer.get("rentable", False):
+        return False
+    if offer.get("gpu_name", "") not in cfg.preferred_gpus:
+        return False
+    if offer.get("num_gpus", 1) != cfg.num_gpus:
+        return False
 
-    return filtered
+    return (offer.get("dph_total", 999) <= cfg.max_price_per_hour and
+            offer.get("reliability2", 0) >= cfg.min_reliability and
+            offer.get("disk_space", 0) >= cfg.min_disk_space and
+            offer.get("inet_down", 0) >= cfg.min_inet_down and
+            offer.get("inet_up", 0) >= cfg.min_inet_up)
 
 
-def score_offer(offer: dict, cfg: Config) -> float:
+def score_offer(price: float, reliability: float, inv_max_price: float) -> float:
     """인스턴스 점수 계산 (높을수록 좋음)"""
-    score = 0.0
-
-    price = offer.get("dph_total", 999)
-    reliability = offer.get("reliability2", 0)
-
-    # 가격 점수 (최대 30점)
-    price_score = max(0, 30 * (1 - price / cfg.max_price_per_hour))
-    score += price_score
-
-    # 신뢰도 점수 (최대 15점)
-    score += reliability * 15
+    # 가격 점수 (최대 30점) + 신뢰도 점수 (최대 15점)
+    price_score = 30.0 * (1.0 - price * inv_max_price)
+    price_score = price_score if price_score > 0 else 0.0
+    return price_score + reliability * 15
 
-    return score
 
-
-def select_best_offer(offers: list, cfg: Config) -> Optional[dict]:
-    """최적의 인스턴스 선택"""
-    valid_offers = filter_offers(offers, cfg)
-
-    if not valid_offers:
+def select_best(offers: list, cfg: Config) -> Optional[dict]:
+    """이미 필터링된 인스턴스들 중 점수가 가장 높은 인스턴스 선택"""
+    if not offers:
         return None
 
-    scored = [(offer, score_offer(offer, cfg)) for offer in valid_offers]
-    scored.sort(key=lambda x: x[1], reverse=True)
-
-    return scored[0][0]
+    # 나눗셈 대신 역수를 한 번만 계산해 곱셈으로 처리
+    inv_max_price = 1.0 / cfg.max_price_per_hour
+    return max(offers, key=lambda offer: score_offer(offer.get("dph_total", 999),
+                                                     offer.get("reliability2", 0), inv_max_price))
 
 
 # ============================================================
@@ -181,35 +341,49 @@ def print_offer_info(offer: dict):
 
 def build_env_vars(cfg: Config, instance_id: str = "") -> dict:
     """Docker 컨테이너에 전달할 환경변수 구성"""
-    env = {
-        "WANDB_API_KEY": cfg.env_vars.get("wandb_key", ""),
-        "AWS_ACCESS_KEY_ID": cfg.env_vars.get("aws_key", ""),
-        "AWS_SECRET_ACCESS_KEY": cfg.env_vars.get("aws_secret", ""),
-        "AWS_DEFAULT_REGION": cfg.env_vars.get("aws_region", "ap-northeast-2"),
-        "S3_DATA_PATH": cfg.env_vars.get("s3_path", ""),
-        "VAST_API_KEY": cfg.api_key,
-        "CONTAINER_ID": instance_id,
-        "CONFIG_FILE": cfg.config_file,
-    }
-    return {k: v for k, v in env.items() if v}
-
-
-def launch(cfg: Config, dry_run: bool = False) -> Optional[dict]:
+    env = dict(cfg._env_base)
+    if cfg.api_key:
+        env["VAST_API_KEY"] = cfg.api_key
+    if instance_id:
+        env["CONTAINER_ID"] = instance_id
+    if cfg.config_file:
+        env["CONFIG_FILE"] = cfg.config_file
+    return env
+
+
+def gather_state(client: VastClient, cfg: Config) -> tuple:
+    """인스턴스 검색과 내 인스턴스 조회를 병렬로 수행 (내 인스턴스 조회 실패 시 None)"""
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        offers_future = executor.submit(lambda: list(client.search_offers(cfg)))
+        instances_future = executor.submit(client.get_instances)
+        offers = offers_future.result()
+
+        # 내 인스턴스 목록은 참고용이므로 조회에 실패해도 인스턴스 선택은 계속 진행
+        try:
+            instances = instances_future.result()
+        except Exception as e:
+            print(f"Instance lookup failed: {e}")
+            instances = None
+
+        return offers, instances
+
+
+def launch(cfg: Config, client: VastClient, dry_run: bool = False) -> Optional[dict]:
     """메인 실행 함수"""
     print("Searching for instances on Vast.ai...")
 
-    client = VastClient(cfg.api_key)
-
-    # 1. 사용 가능한 인스턴스 검색
+    # 1. 사용 가능한 인스턴스 검색 (내 인스턴스 목록도 함께 조회)
     try:
-        offers = client.search_offers()
-        print(f"Found {len(offers)} total offers")
+        offers, instances = gather_state(client, cfg)
+        print(f"Found {len(offers)} matching offers")
+        if instances is not None:
+            print(f"  ({len(instances)} instance(s) already running on this account)")
     except Exception as e:
         print(f"Search failed: {e}")
         return None
 
     # 2. 최적 인스턴스 선택
-    best = select_best_offer(offers, cfg)
+    best = select_best(offers, cfg)
 
     if not best:
         print("No instances matching the criteria found.")
@@ -242,19 +416,19 @@ def launch(cfg: Config, dry_run: bool = False) -> Optional[dict]:
             onstart=onstart_cmd,
             env=env_vars
         )
-        instance_id = result.get('new_contract')
-        print(f"\nInstance created successfully!")
-        print(f"  Instance ID: {instance_id}")
-        print(f"\nMonitor at: https://cloud.vast.ai/instances/")
-        return result
     except Exception as e:
         print(f"Creation failed: {e}")
         return None
 
+    instance_id = result.get('new_contract')
+    print(f"\nInstance created successfully!")
+    print(f"  Instance ID: {instance_id}")
+    print(f"\nMonitor at: https://cloud.vast.ai/instances/")
+    return result
 
-def list_my_instances(cfg: Config):
+
+def list_my_instances(client: VastClient):
     """내 인스턴스 목록 조회"""
-    client = VastClient(cfg.api_key)
     instances = client.get_instances()
 
     print(f"\nMy Instances ({len(instances)})")
@@ -350,7 +524,7 @@ def main():
         min_reliability=args.min_reliability,
         disk_space=args.disk,
         num_gpus=args.gpus,
-        preferred_gpus=tuple(args.gpu_type),
+        preferred_gpus=frozenset(args.gpu_type),
         config_file=args.config,
         extra_args=args.extra_args,
         env_vars={
@@ -362,12 +536,14 @@ def main():
         }
     )
 
-    if args.list:
-        list_my_instances(cfg)
-    else:
-        result = launch(cfg, dry_run=args.dry_run)
-        if result is None and not args.dry_run:
-            sys.exit(1)
+    with VastClient(cfg.api_key) as client:
+        if args.list:
+            list_my_instances(client)
+            return
+        result = launch(cfg, client, dry_run=args.dry_run)
+
+    if result is None and not args.dry_run:
+        sys.exit(1)
 
 
 if __name__ == "__main__":